@@ -56,23 +56,26 @@ def main(
                 use_saved=use_saved,
             )
 
-            models = ["food", "energy", "currency"]
+            models = configuration["models"]
             pipeline = Pipeline(configuration, retriever, tempdir)
-            for country_code, model_data in pipeline.aggregate_by_country(models):
-                dataset = pipeline.generate_dataset(country_code, model_data)
-                if dataset:
-                    dataset.update_from_yaml(
-                        script_dir_plus_file(
-                            join("config", "hdx_dataset_static.yaml"), main
+            try:
+                for country_code, model_data in pipeline.aggregate_by_country(models):
+                    dataset = pipeline.generate_dataset(country_code, model_data)
+                    if dataset:
+                        dataset.update_from_yaml(
+                            script_dir_plus_file(
+                                join("config", "hdx_dataset_static.yaml"), main
+                            )
                         )
-                    )
-                    dataset.create_in_hdx(
-                        remove_additional_resources=False,
-                        match_resource_order=False,
-                        hxl_update=False,
-                        updated_by_script=_UPDATED_BY_SCRIPT,
-                        batch=info["batch"],
-                    )
+                        dataset.create_in_hdx(
+                            remove_additional_resources=False,
+                            match_resource_order=False,
+                            hxl_update=False,
+                            updated_by_script=_UPDATED_BY_SCRIPT,
+                            batch=info["batch"],
+                        )
+            finally:
+                pipeline.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""Cache of API pages used for conditional downloads"""
+
+import sqlite3
+import threading
+import time
+from os import makedirs
+from os.path import join
+from typing import Dict, Optional
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS pages (
+    dataset TEXT NOT NULL,
+    page_size INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    PRIMARY KEY (dataset, page_size, offset)
+)
+"""
+
+
+class PageCache:
+    """Stores the raw bodies of downloaded pages in an SQLite database, keyed by
+    dataset, page size and offset, with their ETag and Last-Modified headers so
+    that they can be requested conditionally on the next run, reusing the stored
+    page when the server responds with 304 Not Modified.
+
+    Args:
+        folder (str): Folder in which to store the database
+    """
+
+    def __init__(self, folder: str):
+        makedirs(folder, exist_ok=True)
+        self._connection = sqlite3.connect(
+            join(folder, "pages.sqlite"), check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(_CREATE_TABLE)
+
+    def close(self) -> None:
+        """Close database
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._connection.close()
+
+    def get(self, dataset: str, page_size: int, offset: int) -> Optional[Dict]:
+        """Get cached entry for page
+
+        Args:
+            dataset (str): Dataset of page
+            page_size (int): Page size
+            offset (int): Offset of page
+
+        Returns:
+            Optional[Dict]: Entry with keys etag, last_modified and body or None
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT etag, last_modified, body FROM pages "
+                "WHERE dataset = ? AND page_size = ? AND offset = ?",
+                (dataset, page_size, offset),
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, body = row
+        return {"etag": etag, "last_modified": last_modified, "body": body}
+
+    def set(
+        self,
+        dataset: str,
+        page_size: int,
+        offset: int,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        body: bytes,
+    ) -> None:
+        """Store page. Pages without ETag or Last-Modified headers cannot be
+        requested conditionally so are not stored.
+
+        Args:
+            dataset (str): Dataset of page
+            page_size (int): Page size
+            offset (int): Offset of page
+            etag (Optional[str]): ETag header of response
+            last_modified (Optional[str]): Last-Modified header of response
+            body (bytes): Body of response
+
+        Returns:
+            None
+        """
+        if not etag and not last_modified:
+            return
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    dataset,
+                    page_size,
+                    offset,
+                    etag,
+                    last_modified,
+                    int(time.time()),
+                    body,
+                ),
+            )
+
+    @staticmethod
+    def get_conditional_headers(entry: Optional[Dict]) -> Dict:
+        """Get headers with which to request a page conditionally
+
+        Args:
+            entry (Optional[Dict]): Cached entry or None
+
+        Returns:
+            Dict: Request headers
+        """
+        headers = {}
+        if not entry:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
@@ -1,21 +1,48 @@
 #!/usr/bin/python
 """Worldbank_rtp scraper"""
 
+import csv
 import logging
-from collections import defaultdict
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Iterator, List, Optional, Tuple
+from functools import lru_cache, partial
+from itertools import islice
+from os import replace
+from os.path import join
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+import orjson
 from hdx.api.configuration import Configuration
 from hdx.data.dataset import Dataset
 from hdx.data.hdxobject import HDXError
+from hdx.data.resource import Resource
 from hdx.location.country import Country
 from hdx.utilities.dateparse import parse_date
+from hdx.utilities.downloader import Download
 from hdx.utilities.retriever import Retrieve
 from slugify import slugify
 
+from hdx.scraper.worldbank_rtp.page_cache import PageCache
+
 logger = logging.getLogger(__name__)
 
+# Formats for which datetime.fromisoformat can be used in place of strptime
+_ISO_DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S")
+
+
+@lru_cache(maxsize=65536)
+def _parse_date(date: str) -> datetime:
+    """Parse date, caching the result as the same dates recur across markets"""
+    return parse_date(date)
+
+
+@lru_cache(maxsize=512)
+def _get_country_name(iso3: str) -> Optional[str]:
+    """Get country name from ISO3 code, caching the result"""
+    return Country.get_country_name_from_iso3(iso3)
+
 
 class Pipeline:
     def __init__(
@@ -27,62 +54,206 @@ class Pipeline:
         self._configuration = configuration
         self._retriever = retriever
         self._tempdir = tempdir
+        page_cache_dir = configuration.get("page_cache_dir")
+        self._page_cache = PageCache(page_cache_dir) if page_cache_dir else None
+        self._page_size = configuration["page_size"]
+        self._max_workers = configuration["max_concurrent_requests"]
+        self._timeout = configuration["timeout"]
+        self._csv_fields = set(configuration.get("csv_fields") or [])
+        self._local = threading.local()
 
-    def fetch_data(self, model: str, max_records: Optional[int] = None):
-        limit = 1000
-        offset = 0
-        total = max_records
+    def close(self) -> None:
+        """Close page cache if there is one
 
-        while True:
-            data_url = f"{self._configuration['base_url']}{self._configuration[model]}?limit={limit}&offset={offset}"
-            response = self._retriever.download_json(data_url)
+        Returns:
+            None
+        """
+        if self._page_cache is not None:
+            self._page_cache.close()
 
-            if total is None:
-                total = response.get("total", 0)
+    def _get_retriever(self) -> Retrieve:
+        """Get a retriever for the current thread. Each thread gets its own
+        downloader (which holds per-request state) sharing the session of the
+        main retriever.
+        """
+        retriever = getattr(self._local, "retriever", None)
+        if retriever is None:
+            downloader = Download(session=self._retriever.downloader.session)
+            retriever = self._retriever.clone(downloader)
+            self._local.retriever = retriever
+        return retriever
 
-            batch = response.get("data", [])
-            if not batch:
-                break
+    def _fetch_page(self, model: str, limit: int, offset: int) -> Dict:
+        """Download a page of a model, decoding it with orjson. If there is a
+        page cache, the page is requested conditionally if it is cached and the
+        cached page is reused if the server reports it is unchanged. Saved data
+        mode and saving data go through the retriever.
+        """
+        dataset = self._configuration[model]
+        data_url = (
+            f"{self._configuration['base_url']}{dataset}?limit={limit}&offset={offset}"
+        )
+        retriever = self._get_retriever()
+        if retriever.use_saved or retriever.save:
+            return retriever.download_json(data_url, timeout=self._timeout)
+        entry = None
+        if self._page_cache is not None:
+            entry = self._page_cache.get(dataset, limit, offset)
+        downloader = retriever.downloader
+        logger.info(f"Downloading {data_url}")
+        downloader.download(
+            data_url,
+            headers=PageCache.get_conditional_headers(entry),
+            timeout=self._timeout,
+        )
+        if entry and downloader.get_status() == 304:
+            logger.info(f"Using cached page as unchanged: {data_url}")
+            return orjson.loads(entry["body"])
+        body = downloader.response.content
+        if self._page_cache is not None:
+            self._page_cache.set(
+                dataset,
+                limit,
+                offset,
+                downloader.get_header("ETag"),
+                downloader.get_header("Last-Modified"),
+                body,
+            )
+        return orjson.loads(body)
 
-            for record in batch:
-                yield record
+    def fetch_data(self, model: str, max_records: Optional[int] = None):
+        """
+        Fetch all records for a model. The first page is downloaded to learn
+        the total and the page size the server allows, then the remaining pages
+        are downloaded concurrently, ahead of the caller consuming them, and
+        yielded in order.
+        """
+        limit = self._page_size
+        response = self._fetch_page(model, limit, 0)
+        total = max_records
+        if total is None:
+            total = response.get("total", 0)
 
-            offset += limit
-            if offset >= total:
-                break
+        batch = response.get("data", [])
+        if not batch:
+            return
+        # The server may cap the page size below the one requested, in which
+        # case page through using the number of records it actually returned
+        if len(batch) < min(limit, total):
+            logger.info(f"Page size for {model} capped by server at {len(batch)}")
+            limit = len(batch)
+
+        offsets = iter(range(limit, total, limit))
+        fetch_page = partial(self._fetch_page, model, limit)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            # Keep a bounded window of pages downloading while the current page,
+            # starting with the first, is processed rather than buffering every
+            # page
+            futures = deque(
+                executor.submit(fetch_page, offset)
+                for offset in islice(offsets, self._max_workers)
+            )
+            try:
+                yield from batch
+                while futures:
+                    response = futures.popleft().result()
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        futures.append(executor.submit(fetch_page, offset))
+                    yield from response.get("data", [])
+            finally:
+                for future in futures:
+                    future.cancel()
 
     def aggregate_by_country(
         self, models: List, max_records: Optional[int] = None
     ) -> Iterator[Tuple]:
         """
-        Aggregate data by country across all models
-        Return a nested dict: {country: {model: [records]}}
+        Aggregate data by country across all models, streaming each record to a
+        CSV file per country and model rather than holding records in memory
+        Return a nested dict: {country: {model: aggregate}} where each aggregate
+        holds the CSV path, number of rows and min/max date
         """
-        country_data = defaultdict(lambda: defaultdict(list))
+        country_data = {}
+        unknown_countries = set()
 
         for model in models:
-            for record in self.fetch_data(model, max_records):
-                country_code = record.get("ISO3", "Unknown")
-                record["DATES"] = parse_date(record.get("DATES"))
-                country_data[country_code][model].append(record)
-
-                # If one country gets big, yield it and reset
-                total_records = sum(
-                    len(records) for records in country_data[country_code].values()
-                )
-                if total_records >= 10000:
-                    yield country_code, country_data[country_code]
-                    del country_data[country_code]  # Free up memory
-
-        # Yield remaining countries
+            # Aggregates of the current model by country
+            model_aggregates = {}
+            try:
+                for record in self.fetch_data(model, max_records):
+                    country_code = record.get("ISO3")
+                    aggregate = model_aggregates.get(country_code)
+                    # Drop records for countries that cannot be resolved before
+                    # doing any work on them
+                    if aggregate is None and (
+                        not country_code or not _get_country_name(country_code)
+                    ):
+                        if country_code not in unknown_countries:
+                            logger.warning(f"Unknown ISO3: {country_code}")
+                            unknown_countries.add(country_code)
+                        continue
+                    # Parsed date is only used for the date range so the record
+                    # is written with its original date string
+                    date = _parse_date(record.get("DATES"))
+                    if aggregate is None:
+                        aggregate = self._open_aggregate(
+                            country_code, model, self._get_headers(record), date
+                        )
+                        model_aggregates[country_code] = aggregate
+                        country_data.setdefault(country_code, {})[model] = aggregate
+                    elif date < aggregate["min_date"]:
+                        aggregate["min_date"] = date
+                    elif date > aggregate["max_date"]:
+                        aggregate["max_date"] = date
+                    aggregate["writer"].writerow(map(record.get, aggregate["headers"]))
+                    aggregate["rows"] += 1
+            finally:
+                # Each country's file for this model is complete
+                for aggregate in model_aggregates.values():
+                    del aggregate["writer"]
+                    del aggregate["headers"]
+                    aggregate.pop("file").close()
+
         for country_code, model_data in country_data.items():
-            if any(model_data.values()):
-                yield country_code, model_data
+            yield country_code, model_data
+
+    def _get_headers(self, record: Dict) -> List:
+        """Get CSV headers from a record, keeping only the configured fields if
+        any are configured. Raises a ValueError if none of the configured
+        fields are in the record.
+        """
+        if not self._csv_fields:
+            return list(record.keys())
+        headers = [field for field in record if field in self._csv_fields]
+        if not headers:
+            raise ValueError(
+                f"None of csv_fields {sorted(self._csv_fields)} are in record "
+                f"fields {list(record.keys())}"
+            )
+        return headers
+
+    def _open_aggregate(
+        self, country_code: str, model: str, headers: List, date: datetime
+    ) -> Dict:
+        path = join(self._tempdir, f"{slugify(country_code)}-{model}.csv")
+        file = open(path, "w", encoding="utf-8", newline="")
+        writer = csv.writer(file)
+        writer.writerow(headers)
+        return {
+            "path": path,
+            "file": file,
+            "writer": writer,
+            "headers": headers,
+            "rows": 0,
+            "min_date": date,
+            "max_date": date,
+        }
 
     def generate_dataset(
         self, country_code: str, country_model_data: Dict
     ) -> Optional[Dataset]:
-        country_name = Country.get_country_name_from_iso3(country_code)
+        country_name = _get_country_name(country_code)
         if not country_name:
             logger.warning(f"Unknown ISO3: {country_code}")
             return None
@@ -91,10 +262,7 @@ class Pipeline:
         dataset_name = slugify(dataset_title)
 
         # Get min/max date across all models
-        all_records = [
-            r for model_records in country_model_data.values() for r in model_records
-        ]
-        min_date, max_date = self.get_date_range(all_records)
+        min_date, max_date = self.get_date_range(country_model_data.values())
 
         dataset_tags = self._configuration["tags"]
 
@@ -116,49 +284,57 @@ class Pipeline:
             return None
 
         # Add a resource per model
-        for model, records in country_model_data.items():
-            resource_name = f"Real Time {model.capitalize()} Prices for {country_name}"
+        for model, aggregate in country_model_data.items():
+            resource_name = self._configuration["resource_name"].format(
+                model=model.capitalize(), country_name=country_name
+            )
             resource_description = f"description_{model}"
             resource_data = {
                 "name": resource_name,
                 "description": self._configuration.get(resource_description, ""),
             }
 
-            dataset.generate_resource_from_iterable(
-                headers=list(records[0].keys()),
-                iterable=records,
-                hxltags={},
-                folder=self._tempdir,
-                filename=f"{slugify(resource_name)}.csv",
-                resourcedata=resource_data,
-                quickcharts=None,
-            )
+            path = join(self._tempdir, f"{slugify(resource_name)}.csv")
+            replace(aggregate["path"], path)
+            aggregate["path"] = path
+
+            resource = Resource(resource_data)
+            resource.set_format("csv")
+            resource.set_file_to_upload(path)
+            dataset.add_update_resource(resource)
 
         return dataset
 
     def format_date(self, date_str: str, date_fmt: str = None) -> str:
         if not date_str:
             return ""
+        if not date_fmt or date_fmt in _ISO_DATE_FORMATS:
+            # fromisoformat is much faster than strptime. Given a format, only
+            # use its result if the string is exactly in that format
+            try:
+                dt = datetime.fromisoformat(date_str)
+            except (TypeError, ValueError):
+                dt = None
+            if dt and (not date_fmt or dt.strftime(date_fmt) == date_str):
+                return dt.date().isoformat()  # Return 'YYYY-MM-DD' format
+            if not date_fmt:
+                return date_str  # Return original value if parsing fails
         try:
-            if date_fmt:
-                dt = datetime.strptime(date_str, date_fmt)
-            else:
-                dt = datetime.fromisoformat(date_str.replace("Z", "+00:00"))
-            return dt.date().isoformat()  # Return 'YYYY-MM-DD' format
-        except Exception:
-            return date_str  # Return original value if parsing fails
+            dt = datetime.strptime(date_str, date_fmt)
+        except (TypeError, ValueError):
+            return date_str
+        return dt.date().isoformat()
 
     def get_date_range(
-        self, records: List
+        self, aggregates: Iterable[Dict]
     ) -> Tuple[Optional[datetime], Optional[datetime]]:
-        dates = []
-        for rec in records:
-            date = rec.get("DATES")
-            if not date:
-                continue
-            dates.append(date)
-
-        if not dates:
+        min_dates = []
+        max_dates = []
+        for aggregate in aggregates:
+            min_dates.append(aggregate["min_date"])
+            max_dates.append(aggregate["max_date"])
+
+        if not min_dates:
             return None, None
 
-        return min(dates), max(dates)
+        return min(min_dates), max(max_dates)
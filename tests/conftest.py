@@ -50,4 +50,7 @@ def configuration(config_dir):
         "id": "b891512e-9516-4bf5-962a-7a289772a2a1",
         "name": "approved",
     }
-    return Configuration.read()
+    configuration = Configuration.read()
+    # Saved input fixtures were recorded with a page size of 1000
+    configuration["page_size"] = 1000
+    return configuration
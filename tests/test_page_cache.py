@@ -0,0 +1,30 @@
+from hdx.utilities.path import temp_dir
+
+from hdx.scraper.worldbank_rtp.page_cache import PageCache
+
+
+class TestPageCache:
+    def test_page_cache(self):
+        with temp_dir(
+            "TestWorldbank_rtp_PageCache",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            page_cache = PageCache(tempdir)
+            dataset = "wld_2021_rtfp_v02_m"
+            assert page_cache.get(dataset, 1000, 0) is None
+            assert PageCache.get_conditional_headers(None) == {}
+
+            page_cache.set(dataset, 1000, 0, None, None, b'{"data": []}')
+            assert page_cache.get(dataset, 1000, 0) is None
+
+            body = b'{"total": 1, "data": [{"ISO3": "AFG"}]}'
+            page_cache.set(dataset, 1000, 0, '"abc"', None, body)
+            entry = page_cache.get(dataset, 1000, 0)
+            assert entry["body"] == body
+            assert PageCache.get_conditional_headers(entry) == {
+                "If-None-Match": '"abc"'
+            }
+            assert page_cache.get(dataset, 1000, 1000) is None
+            assert page_cache.get(dataset, 10000, 0) is None
+            page_cache.close()
@@ -1,12 +1,97 @@
+import csv
+import logging
+import threading
+from itertools import chain, islice
+from os import listdir
 from os.path import join
+from time import monotonic, sleep
 
+import orjson
+import pytest
 from hdx.utilities.downloader import Download
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
+from requests import Response
+from requests.structures import CaseInsensitiveDict
 
 from hdx.scraper.worldbank_rtp.pipeline import Pipeline
 
 
+class FakeSession:
+    """Session returning canned responses and recording request headers"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.request_headers = []
+
+    def get(self, url, stream=False, timeout=None, headers=None):
+        self.request_headers.append(headers)
+        status_code, response_headers, payload = self.responses.pop(0)
+        response = Response()
+        response.url = url
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(response_headers)
+        response._content = orjson.dumps(payload) if payload else b""
+        return response
+
+    def close(self):
+        pass
+
+
+def get_page(rows, total=None):
+    data = [{"ISO3": "AFG", "DATES": "2024-01-01", "row": row} for row in rows]
+    return {"total": len(data) if total is None else total, "data": data}
+
+
+class FakePages:
+    """Serves pages of numbered records in place of Pipeline._fetch_page,
+    recording the (limit, offset) of each request and the order in which
+    requests complete"""
+
+    def __init__(self, total, page_cap=None, delay=None, gate=None):
+        self.total = total
+        self.page_cap = page_cap
+        self.delay = delay
+        # Event which requests after the first page wait on if given
+        self.gate = gate
+        self.requests = []
+        self.completed = []
+        # Number of pages the consumer has started on, set by the test
+        self.consumed = 0
+        self.consumed_at_request = []
+
+    def __call__(self, model, limit, offset):
+        self.requests.append((limit, offset))
+        self.consumed_at_request.append((offset, self.consumed))
+        if self.page_cap:
+            limit = min(limit, self.page_cap)
+        if self.gate and offset:
+            self.gate.wait()
+        if self.delay:
+            sleep(self.delay(offset))
+        self.completed.append(offset)
+        return get_page(range(offset, min(offset + limit, self.total)), self.total)
+
+
+def wait_for(condition, timeout=5):
+    """Wait for a condition set by worker threads to become true"""
+    end = monotonic() + timeout
+    while not condition():
+        if monotonic() > end:
+            return False
+        sleep(0.001)
+    return True
+
+
+def get_pipeline(configuration, fake_pages, page_size, max_concurrent_requests=4):
+    pipeline_configuration = dict(configuration)
+    pipeline_configuration["page_size"] = page_size
+    pipeline_configuration["max_concurrent_requests"] = max_concurrent_requests
+    pipeline = Pipeline(pipeline_configuration, None, None)
+    pipeline._fetch_page = fake_pages
+    return pipeline
+
+
 class TestPipeline:
     def test_pipeline(self, configuration, fixtures_dir, input_dir, config_dir):
         with temp_dir(
@@ -23,7 +108,7 @@ class TestPipeline:
                     save=False,
                     use_saved=True,
                 )
-                models = ["food", "energy", "currency"]
+                models = configuration["models"]
                 pipeline = Pipeline(configuration, retriever, tempdir)
                 for country_code, model_data in pipeline.aggregate_by_country(
                     models, max_records=10
@@ -96,3 +181,215 @@ class TestPipeline:
                         ]
 
                     break
+
+    def test_fetch_data_live(self, configuration, monkeypatch):
+        with temp_dir(
+            "TestWorldbank_rtp_Live",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            page_one = get_page(range(1000), 1500)
+            page_two = get_page(range(1000, 1500), 1500)
+            session = FakeSession([(200, {}, page_one), (200, {}, page_two)])
+            retriever = Retrieve(
+                downloader=Download(session=session),
+                fallback_dir=tempdir,
+                saved_dir=tempdir,
+                temp_dir=tempdir,
+            )
+
+            def download_json(*args, **kwargs):
+                raise AssertionError("Live pages should not use download_json")
+
+            # Each thread clones the retriever so patch the class
+            monkeypatch.setattr(Retrieve, "download_json", download_json)
+            pipeline = Pipeline(dict(configuration), retriever, tempdir)
+            assert pipeline._page_cache is None
+            records = list(pipeline.fetch_data("food"))
+            assert records == page_one["data"] + page_two["data"]
+            # No page cache so requests are unconditional
+            assert session.request_headers == [{}, {}]
+            assert listdir(tempdir) == []
+            pipeline.close()
+
+    def test_fetch_data_page_cache(self, configuration):
+        with temp_dir(
+            "TestWorldbank_rtp_PageCache",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            page_one = get_page(range(3))
+            page_two = get_page(range(3, 5))
+            session = FakeSession(
+                [
+                    (200, {"ETag": '"v1"'}, page_one),
+                    (304, {"ETag": '"v1"'}, None),
+                    (200, {"ETag": '"v2"'}, page_two),
+                    (304, {"ETag": '"v2"'}, None),
+                ]
+            )
+            retriever = Retrieve(
+                downloader=Download(session=session),
+                fallback_dir=tempdir,
+                saved_dir=tempdir,
+                temp_dir=tempdir,
+            )
+            pipeline_configuration = dict(configuration)
+            pipeline_configuration["page_cache_dir"] = tempdir
+            pipeline = Pipeline(pipeline_configuration, retriever, tempdir)
+
+            # Nothing cached so unconditional request
+            assert list(pipeline.fetch_data("food")) == page_one["data"]
+            assert session.request_headers[0] == {}
+            # Unchanged so cached page used
+            assert list(pipeline.fetch_data("food")) == page_one["data"]
+            assert session.request_headers[1] == {"If-None-Match": '"v1"'}
+            # Changed so new page returned and cached page replaced
+            assert list(pipeline.fetch_data("food")) == page_two["data"]
+            assert session.request_headers[2] == {"If-None-Match": '"v1"'}
+            assert list(pipeline.fetch_data("food")) == page_two["data"]
+            assert session.request_headers[3] == {"If-None-Match": '"v2"'}
+            pipeline.close()
+
+    def test_fetch_data_page_size_capped(self, configuration):
+        fake_pages = FakePages(2500, page_cap=1000)
+        pipeline = get_pipeline(configuration, fake_pages, 10000)
+        records = list(pipeline.fetch_data("food"))
+        assert [record["row"] for record in records] == list(range(2500))
+        # First page is requested at the configured size and the rest at the
+        # size the server returned
+        assert fake_pages.requests[0] == (10000, 0)
+        assert sorted(fake_pages.requests[1:]) == [(1000, 1000), (1000, 2000)]
+
+    def test_fetch_data_order(self, configuration):
+        # Later pages download faster so complete out of order
+        fake_pages = FakePages(5000, delay=lambda offset: (5000 - offset) / 50000)
+        pipeline = get_pipeline(configuration, fake_pages, 1000)
+        records = list(pipeline.fetch_data("food"))
+        assert fake_pages.completed != sorted(fake_pages.completed)
+        assert [record["row"] for record in records] == list(range(5000))
+
+    def test_fetch_data_early_close(self, configuration):
+        gate = threading.Event()
+        fake_pages = FakePages(2000, gate=gate)
+        pipeline = get_pipeline(
+            configuration, fake_pages, 100, max_concurrent_requests=2
+        )
+        records = pipeline.fetch_data("food")
+        assert next(records)["row"] == 0
+        # The window is submitted before the first page is consumed
+        assert wait_for(lambda: len(fake_pages.requests) == 3)
+        gate.set()
+        records.close()
+        # Nothing more is submitted after closing
+        assert sorted(fake_pages.requests) == [(100, 0), (100, 100), (100, 200)]
+
+        fake_pages = FakePages(2000, delay=lambda offset: 0.01)
+        pipeline = get_pipeline(
+            configuration, fake_pages, 100, max_concurrent_requests=2
+        )
+        records = pipeline.fetch_data("food")
+        # Read into the first concurrently fetched page then stop
+        assert [record["row"] for record in islice(records, 101)] == list(range(101))
+        records.close()
+        # First page, the initial window and the page submitted to replace the
+        # one taken from it, not all 20 pages
+        assert len(fake_pages.requests) <= 4
+
+    def test_fetch_data_bounded_window(self, configuration):
+        max_concurrent_requests = 3
+        fake_pages = FakePages(5000, delay=lambda offset: 0.001)
+        pipeline = get_pipeline(configuration, fake_pages, 100, max_concurrent_requests)
+        rows = []
+        records = pipeline.fetch_data("food")
+        record = next(records)
+        # The first page overlaps with downloading the window
+        assert wait_for(lambda: len(fake_pages.requests) == max_concurrent_requests + 1)
+        for record in chain([record], records):
+            fake_pages.consumed = record["row"] // 100 + 1
+            rows.append(record["row"])
+            sleep(0.00002)
+        assert rows == list(range(5000))
+        assert len(fake_pages.requests) == 50
+        for offset, consumed in fake_pages.consumed_at_request:
+            assert offset // 100 <= consumed + max_concurrent_requests
+
+    def test_aggregate_by_country_unknown_iso3(self, configuration, caplog):
+        records = [
+            {"ISO3": "XXX", "DATES": "2024-01-01"},
+            {"DATES": "2024-01-01"},
+            {"ISO3": "AFG", "DATES": "2024-01-02"},
+            {"ISO3": "", "DATES": "2024-01-01"},
+            {"ISO3": "XXX", "DATES": "2024-01-03"},
+            {"ISO3": "AFG", "DATES": "2024-01-01"},
+        ]
+        with temp_dir(
+            "TestWorldbank_rtp_unknown_iso3",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            pipeline = Pipeline(dict(configuration), None, tempdir)
+            pipeline.fetch_data = lambda model, max_records: iter(records)
+            with caplog.at_level(logging.WARNING):
+                aggregates = dict(pipeline.aggregate_by_country(["food", "exchange"]))
+            assert list(aggregates) == ["AFG"]
+            assert aggregates["AFG"]["food"]["rows"] == 2
+            assert aggregates["AFG"]["exchange"]["rows"] == 2
+            assert sorted(listdir(tempdir)) == ["afg-exchange.csv", "afg-food.csv"]
+        # One warning per code across all models, with missing and empty codes
+        # both treated as unknown
+        warnings = [record.getMessage() for record in caplog.records]
+        assert warnings == [
+            "Unknown ISO3: XXX",
+            "Unknown ISO3: None",
+            "Unknown ISO3: ",
+        ]
+
+    def test_aggregate_by_country_csv_fields(self, configuration):
+        records = [
+            {"ISO3": "AFG", "mkt_name": "Kabul", "DATES": "2024-01-01", "o": 1.5},
+            {"ISO3": "AFG", "mkt_name": "Herat", "DATES": "2024-01-02", "o": 2.5},
+        ]
+        with temp_dir(
+            "TestWorldbank_rtp_csv_fields",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            pipeline_configuration = dict(configuration)
+            pipeline_configuration["csv_fields"] = ["DATES", "ISO3", "o"]
+            pipeline = Pipeline(pipeline_configuration, None, tempdir)
+            pipeline.fetch_data = lambda model, max_records: iter(records)
+            aggregates = dict(pipeline.aggregate_by_country(["food"]))
+            with open(aggregates["AFG"]["food"]["path"], newline="") as file:
+                rows = list(csv.reader(file))
+            # Configured fields are written in the order they are in the record
+            assert rows == [
+                ["ISO3", "DATES", "o"],
+                ["AFG", "2024-01-01", "1.5"],
+                ["AFG", "2024-01-02", "2.5"],
+            ]
+
+            pipeline_configuration["csv_fields"] = ["missing"]
+            pipeline = Pipeline(pipeline_configuration, None, tempdir)
+            pipeline.fetch_data = lambda model, max_records: iter(records)
+            with pytest.raises(ValueError, match="None of csv_fields"):
+                dict(pipeline.aggregate_by_country(["food"]))
+
+    def test_format_date(self, configuration):
+        pipeline = Pipeline(configuration, None, None)
+        assert pipeline.format_date("") == ""
+        assert pipeline.format_date("2024-01-02") == "2024-01-02"
+        assert pipeline.format_date("2024-01-02T03:04:05Z") == "2024-01-02"
+        assert pipeline.format_date("2024-01-02", "%Y-%m-%d") == "2024-01-02"
+        assert (
+            pipeline.format_date("2024-01-02 03:04:05", "%Y-%m-%d %H:%M:%S")
+            == "2024-01-02"
+        )
+        # Explicit format is respected even when the string is valid ISO
+        assert pipeline.format_date("2024-01-02", "%Y-%d-%m") == "2024-02-01"
+        assert pipeline.format_date("2024-01-02T03:04", "%Y-%m-%d") == (
+            "2024-01-02T03:04"
+        )
+        assert pipeline.format_date("02/01/2024", "%d/%m/%Y") == "2024-01-02"
+        assert pipeline.format_date("junk") == "junk"
+        assert pipeline.format_date("junk", "%d/%m/%Y") == "junk"